@@ -3,25 +3,51 @@
 from __future__ import annotations
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
+import errno
+import heapq
 import os
 import time
 import unicodedata
-import xml.etree.ElementTree as ET
 from pathlib import Path
-from typing import Iterable, Optional
+from typing import Iterable, Iterator, Optional
 from urllib.parse import unquote, urlparse
 import json
+from json.encoder import encode_basestring
 import shutil
 
+# lxml is optional: it streams TRACK elements faster, but the stdlib parser works fine without it
+try:
+    from lxml import etree as ET
+    HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAVE_LXML = False
+
+# orjson is optional too: faster manifest (JSONL) encoding/decoding, stdlib json otherwise
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
 MOVE_COMMAND = "move"
 PREVIEW_COMMAND = "preview"
 RESTORE_COMMAND = "restore"
 
 DEFAULT_EXTENSIONS = ("mp3", "wav", "aiff", "aif", "flac", "m4a")
 DEFAULT_ORPHANS_DIR_NAME = "_Rekordbox_Orphans"
-DEFAULT_EXCLUDED_DIRNAMES = (DEFAULT_ORPHANS_DIR_NAME,)
+DEFAULT_EXCLUDED_DIRNAMES = frozenset({DEFAULT_ORPHANS_DIR_NAME})
 DEFAULT_MANIFEST_NAME = "orphans_manifest.jsonl"
+MANIFEST_WRITE_BATCH = 128
+
+_FILE_URI_PREFIX = "file://"
+
+# Built once: the scan loop checks every file name against these
+_APPLEDOUBLE_PREFIX = "._"
+# A tuple so str.endswith can take it
+_AUDIO_SUFFIXES = tuple("." + e.lower().lstrip(".") for e in DEFAULT_EXTENSIONS)
 
 # TODO: At the end update to latest rekordbox version and test the XML parsing
 # NOTE: https://github.com/dylanljones/pyrekordbox
@@ -36,7 +62,7 @@ class Config:
     orphans_dir: Path
     manifest_path: Path
 
-def parse_command_line_args() -> Config:
+def parse_command_line_args(argv: Optional[list[str]] = None) -> Config:
     ap = argparse.ArgumentParser(description="Rekordbox orphan file cleaner (XML vs disk paths)")
     sub = ap.add_subparsers(dest="cmd", required=True)
 
@@ -51,7 +77,7 @@ def parse_command_line_args() -> Config:
     _add_common_args(p_restore)
     p_restore.add_argument("--dry-run", action="store_true", help="Print restore operations without changing anything")
 
-    args = ap.parse_args()
+    args = ap.parse_args(argv)
 
     xml_path = Path(args.rekordbox_xml).expanduser()
     if not xml_path.exists():
@@ -78,51 +104,64 @@ def parse_command_line_args() -> Config:
         manifest_path=manifest_path,
     )
 
-def scan_rekordbox_xml(xml_path: Path) -> set[Path]:
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-
-    paths: set[Path] = set()
-    for track in root.iter("TRACK"):
-        loc = track.attrib.get("Location")
-        p = _convert_rekordbox_location_to_path(loc) if loc else None
+def scan_rekordbox_xml(xml_path: Path) -> dict[str, str]:
+    '''
+    Stream the TRACK elements of a Rekordbox XML export.
+    Returns {comparison key: absolute path} for every Location in the collection.
+    The key is the NFC form used to match disk files; the path keeps the name as written.
+    '''
+    paths: dict[str, str] = {}
+    # Tracks share a handful of album/artist folders, so resolve each folder only once
+    resolved_dirs: dict[str, str] = {}
+
+    # Bound to locals: this loop runs once per TRACK
+    convert = _convert_rekordbox_location_to_path
+    normalize = _normalize_file_path
+    key = _normalize_unicode
+
+    for track in _iter_rekordbox_tracks(xml_path):
+        loc = track.get("Location")
+        p = convert(loc) if loc else None
         if p:
-            paths.add(_normalize_path(p))
+            p = normalize(p, resolved_dirs)
+            paths[key(p)] = p
 
     return paths
 
-def scan_disk_files(scan_roots: list[Path]) -> set[Path]:
+def scan_disk_files(scan_roots: list[Path]) -> dict[str, str]:
     '''
     Scan the given directories for audio files.
-    Returns a set of normalized absolute Paths for files with the specified extensions.
+    Returns {comparison key: path on disk} for files with the specified extensions.
+    The key is the NFC form used for matching; the path is exactly what the filesystem
+    returned, so it can be stat'ed and moved even when the name is stored as NFD.
     '''
-    exts = {("." + e.lower().lstrip(".")) for e in (DEFAULT_EXTENSIONS)}
-    scan_roots_norm = [_normalize_path(r) for r in scan_roots]
+    # Resolve each root once. Directories below it are only entered when they are not
+    # symlinks, so every entry.path under a resolved root is already canonical
+    scan_roots_real = [os.path.realpath(os.path.expanduser(r)) for r in scan_roots]
 
-    results: set[Path] = set()
+    results: dict[str, str] = {}
+    subtrees: list[str] = []
 
-    for root in scan_roots_norm:
-        if not root.exists() or not root.is_dir():
+    for root in scan_roots_real:
+        if not os.path.isdir(root):
             continue
-
-        for dirpath, dirnames, filenames in os.walk(root):
-            dirnames[:] = [
-                d for d in dirnames
-                if d not in DEFAULT_EXCLUDED_DIRNAMES
-            ]
-
-            for name in filenames:
-                # Ignore macOS AppleDouble metadata files
-                if _should_ignore_filename(name):
-                    continue
-
-                path = _normalize_path((Path(dirpath) / name))
-                if path.suffix.lower() in exts:
-                    results.add(path)
+        # Files directly under the root are picked up here, each top-level folder becomes its own job
+        subtrees.extend(_scan_directory(root, results))
+
+    if not subtrees:
+        return results
+
+    # Walking is bound by syscall latency (especially on external/network drives) and scandir
+    # releases the GIL, so overlapping the top-level folders on threads cuts wall-clock time
+    max_workers = min(32, (os.cpu_count() or 1) * 4, len(subtrees))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_scan_subtree, top) for top in subtrees]
+        for future in as_completed(futures):
+            results.update(future.result())
     return results
 
 def move_orphans_flat(
-    orphans: Iterable[Path],
+    orphans: Iterable[str],
     *,
     orphans_dir: Path,
     dry_run: bool = True,
@@ -131,6 +170,9 @@ def move_orphans_flat(
     Move orphan files into a flat orphans directory and append a JSONL manifest mapping
     original path -> new path for restore.
 
+    Orphans are expected to be absolute paths as found on disk, as reconcile() returns them,
+    so they are not normalized again here.
+
     Manifest lines look like:
       {"ts": ..., "src": "...", "dst": "...", "size_bytes": ..., "mtime": ..., "dev": ..., "ino": ...}
     """
@@ -138,54 +180,106 @@ def move_orphans_flat(
     orphans_dir.mkdir(parents=True, exist_ok=True)
 
     manifest_path = orphans_dir / DEFAULT_MANIFEST_NAME
+    with os.scandir(orphans_dir) as it:
+        taken_names = {entry.name for entry in it}
 
     moved = 0
     skipped_missing = 0
     errors = 0
 
-    with open(manifest_path, "a", encoding="utf-8") as mf:
-        for src in orphans:
-            src = _normalize_path(src)
-
-            if not src.exists():
-                skipped_missing += 1
-                continue
-
-            try:
-                st = src.stat()
-                dev = getattr(st, "st_dev", None)
-                ino = getattr(st, "st_ino", None)
-
-                # Flat folder: start with original basename
-                dst = orphans_dir / src.name
-                dst = _unique_destination_path(dst)
-
-                record = {
-                    "ts": int(time.time()),
-                    "src": str(src),
-                    "dst": str(dst),
-                    "size_bytes": int(st.st_size),
-                    "mtime": float(st.st_mtime),
-                    "dev": int(dev) if dev is not None else None,
-                    "ino": int(ino) if ino is not None else None,
-                }
-
-                if dry_run:
-                    print("[DRY RUN] MOVE", src, "->", dst)
+    # Manifest lines are buffered and written in batches instead of flushed after every move
+    pending: list[bytes] = []
+    # Every record from one run shares the run's timestamp (one clock read instead of one per file)
+    record: dict = {"ts": int(time.time())}
+
+    with open(manifest_path, "ab") as mf:
+        try:
+            for src in orphans:
+                src = Path(src)
+
+                # A single stat both checks the file is still there and feeds the manifest record
+                try:
+                    st = src.stat()
+                except (FileNotFoundError, NotADirectoryError):
+                    skipped_missing += 1
+                    continue
+                except OSError as e:
+                    # e.g. ELOOP from a symlink loop the scanner kept as a file: report it, move on
+                    errors += 1
+                    print("[ERROR] Failed to move:", src)
+                    print("        ", repr(e))
                     continue
-                
-                shutil.move(str(src), str(dst))
 
-                # Only record after a successful move
-                mf.write(json.dumps(record, ensure_ascii=False) + "\n")
+                try:
+                    dev = getattr(st, "st_dev", None)
+                    ino = getattr(st, "st_ino", None)
+
+                    # Flat folder: start with original basename
+                    dst = orphans_dir / src.name
+
+                    if dry_run:
+                        print("[DRY RUN] MOVE", src, "->", _unique_destination_path(dst, taken_names))
+                        continue
+
+                    # Reserves the name with an empty placeholder that the move below replaces
+                    dst = _unique_destination_path(dst, taken_names, claim=True)
+
+                    # The record is encoded right away, so one dict can be refilled for every file
+                    record["src"] = str(src)
+                    record["dst"] = str(dst)
+                    record["size_bytes"] = int(st.st_size)
+                    record["mtime"] = float(st.st_mtime)
+                    record["dev"] = int(dev) if dev is not None else None
+                    record["ino"] = int(ino) if ino is not None else None
+
+                    try:
+                        # Encode before moving so a record that can't be serialized never leaves
+                        # a moved file without a manifest entry
+                        line = _encode_manifest_record(record)
+
+                        # Same filesystem (the default, orphans dir lives under the scan root):
+                        # a plain rename is one syscall, no shutil bookkeeping.
+                        # os.replace so the placeholder is overwritten on Windows too.
+                        # Device numbers can't predict EXDEV (symlinks, bind mounts), so just try
+                        try:
+                            os.replace(src, dst)
+                        except OSError as e:
+                            if e.errno != errno.EXDEV:
+                                raise
+                            _copy_across_devices(src, dst)
+                    except Exception:
+                        # The move failed, don't leave the placeholder behind
+                        dst.unlink(missing_ok=True)
+                        raise
+                    except BaseException:
+                        # Ctrl-C can land before, during or just after the move. Once src is gone
+                        # the move completed and dst is the user's file: keep it and let the
+                        # finally below write its manifest record
+                        if os.path.lexists(src):
+                            dst.unlink(missing_ok=True)
+                        else:
+                            pending.append(line)
+                        raise
+
+                    # Only record after a successful move
+                    pending.append(line)
+                    if len(pending) >= MANIFEST_WRITE_BATCH:
+                        mf.write(b"".join(pending))
+                        pending.clear()
+
+                    moved += 1
+
+                except Exception as e:
+                    errors += 1
+                    print("[ERROR] Failed to move:", src)
+                    print("        ", repr(e))
+        finally:
+            # Runs on Ctrl-C/unexpected errors too, so every file that was moved is in the manifest
+            if pending:
+                mf.write(b"".join(pending))
+            if not dry_run:
                 mf.flush()
-
-                moved += 1
-
-            except Exception as e:
-                errors += 1
-                print("[ERROR] Failed to move:", src)
-                print("        ", repr(e))
+                os.fsync(mf.fileno())
 
     return {"moved": moved, "skipped_missing": skipped_missing, "errors": errors}
 
@@ -202,99 +296,126 @@ def restore_from_manifest(
     skipped_missing = 0
     errors = 0
 
-    remaining_records: list[str] = []
-
-    with open(manifest_path, "r", encoding="utf-8") as mf:
-        for line in mf:
-            line = line.strip()
-            if not line:
-                continue
+    remaining_records: list[bytes] = []
 
-            rec = json.loads(line)
-            src = _normalize_path(Path(rec["src"]))
-            dst = _normalize_path(Path(rec["dst"]))
+    for line, rec in _read_manifest(manifest_path):
+        # Manifest paths were normalized when they were written, no need to resolve them again
+        src = Path(rec["src"])
+        dst = Path(rec["dst"])
+        if not (src.is_absolute() and dst.is_absolute()):
+            errors += 1
+            print("[ERROR] Manifest entry is not an absolute path, leaving it in the manifest:", src, "->", dst)
+            remaining_records.append(line)
+            continue
 
-            #  Anything skipped here can be cleared out of the manifest since it can't be restored
-            if not dst.exists():
+        #  Anything skipped here can be cleared out of the manifest since it can't be restored
+        if dry_run:
+            if dst.exists():
+                print("[DRY RUN] RESTORE", dst, "->", src)
+            else:
                 skipped_missing += 1
                 print("[SKIP] dst missing:", dst)
-                continue
+            continue
 
+        try:
+            # No exists() check up front, the rename itself reports a missing dst
             try:
+                _rename_or_move(dst, src)
+            except FileNotFoundError:
+                if not dst.exists():
+                    raise
+                # dst is there, so it's the original folder that is gone: recreate it and retry
                 src.parent.mkdir(parents=True, exist_ok=True)
+                _rename_or_move(dst, src)
+            restored += 1
 
-                if dry_run:
-                    print("[DRY RUN] RESTORE", dst, "->", src)
-                    continue
-
-                shutil.move(str(dst), str(src))
-                restored += 1
-
-            except Exception as e:
-                errors += 1
-                print("[ERROR] Failed to restore:", dst)
-                print("        ", repr(e))
-                remaining_records.append(line)
-
-        if not dry_run:
+        except FileNotFoundError as e:
+            if not dst.exists():
+                skipped_missing += 1
+                print("[SKIP] dst missing:", dst)
+                continue
+            # The retry failed too but the file is still in quarantine: keep its manifest line
+            errors += 1
+            print("[ERROR] Failed to restore:", dst)
+            print("        ", repr(e))
+            remaining_records.append(line)
+        except Exception as e:
+            errors += 1
+            print("[ERROR] Failed to restore:", dst)
+            print("        ", repr(e))
+            remaining_records.append(line)
+
+    if not dry_run:
+        if remaining_records:
             tmp_path = manifest_path.with_suffix(".tmp")
 
-            with open(tmp_path, "w", encoding="utf-8") as mf:
-                for line in remaining_records:
-                    mf.write(line.rstrip() + "\n")
-
-            tmp_path.replace(manifest_path)
-
-            # Optional: if manifest is empty, delete it
-            if not remaining_records:
-                manifest_path.unlink(missing_ok=True)
+            with open(tmp_path, "wb") as mf:
+                mf.write(b"".join(line + b"\n" for line in remaining_records))
 
+            os.replace(tmp_path, manifest_path)
+        else:
+            # Nothing left to restore: drop the manifest instead of writing an empty one first
+            manifest_path.unlink(missing_ok=True)
 
     return {"restored": restored, "skipped_missing": skipped_missing, "errors": errors}
 
 def find_broken_moves_from_manifest(
     *,
-    referenced: set[Path],
+    referenced: dict[str, str],
     manifest_path: Path,
 ) -> list[tuple[Path, Path]]:
     bad: list[tuple[Path, Path]] = []
     manifest_path = _normalize_path(manifest_path)
 
     if manifest_path.exists():
-        with open(manifest_path, "r", encoding="utf-8") as mf:
-            for line in mf:
-                line = line.strip()
-                if not line:
-                    continue
-                rec = json.loads(line)
-                src = _normalize_path(Path(rec["src"]))
-                dst = _normalize_path(Path(rec["dst"]))
-
-                # if src was referenced and now missing, this entry likely caused it
-                if src in referenced and not src.exists() and dst.exists():
-                    bad.append((src, dst))
+        for _, rec in _read_manifest(manifest_path):
+            # src is the on-disk spelling; only the lookup goes through the NFC key
+            src = rec["src"]
+            dst = rec["dst"]
+
+            # if src was referenced and now missing, this entry likely caused it
+            if _normalize_unicode(src) in referenced and not os.path.exists(src) and os.path.exists(dst):
+                bad.append((Path(src), Path(dst)))
     return bad
 
 @dataclass(frozen=True)
 class ReconciledMetadata:
-    orphans: list[Path]
-    missing: list[Path]
-    missing_on_disk: list[Path]
-    exists_not_scanned: list[Path]
-
-def reconcile(referenced: set[Path], scanned: set[Path]) -> ReconciledMetadata:
-    orphans = sorted(scanned - referenced, key=str)
-    missing = sorted(referenced - scanned, key=str)
-    missing_on_disk = [p for p in missing if not p.exists()]
-    exists_not_scanned = [p for p in missing if p.exists()]
+    orphans: list[str]
+    missing: list[str]
+    missing_on_disk: list[str]
+    exists_not_scanned: list[str]
+
+def reconcile(referenced: dict[str, str], scanned: dict[str, str]) -> ReconciledMetadata:
+    # Collection and disk in sync (the usual repeat preview): nothing to diff or sort.
+    # Key-view equality bails out on the length check alone when sizes differ
+    if scanned.keys() == referenced.keys():
+        return ReconciledMetadata([], [], [], [])
+
+    # Diff on the NFC keys, report the paths as they are spelled on disk / in the XML so
+    # moves and existence checks hit the real names.
+    # Plain strings all the way: cheaper to hash, compare and sort than Path objects
+    orphans = sorted(scanned[k] for k in scanned.keys() - referenced.keys())
+    missing = sorted(referenced[k] for k in referenced.keys() - scanned.keys())
+
+    # One existence check per missing path, split into both lists in a single pass
+    missing_on_disk: list[str] = []
+    exists_not_scanned: list[str] = []
+    for p in missing:
+        (exists_not_scanned if os.path.exists(p) else missing_on_disk).append(p)
     return ReconciledMetadata(orphans, missing, missing_on_disk, exists_not_scanned)
 
-def print_paths_sample(paths: Iterable[Path], label: str, sample: int = 25) -> None:
+def print_paths_sample(paths: Iterable[str], label: str, sample: int = 25) -> None:
+    paths = list(paths)
     print(f"{label} ({len(paths)}):")
-    for p in sorted(paths, key=str)[:sample]:
+    # Only `sample` entries get printed: a partial heap select is O(n log sample) instead of sorting everything
+    if 0 <= sample < len(paths):
+        head = heapq.nsmallest(sample, paths)
+    else:
+        head = sorted(paths)[:sample]
+    for p in head:
         print(f"  ", p)
 
-def log_preview(reconciled_meta: ReconciledMetadata, config: Config, referenced_paths: set[Path], scanned_paths: set[Path]) -> None:
+def log_preview(reconciled_meta: ReconciledMetadata, config: Config, referenced_paths: dict[str, str], scanned_paths: dict[str, str]) -> None:
     print("=== Preview ===")
     print("Orphans (disk files that are not in rekordbox collection that can be removed):", len(reconciled_meta.orphans))
     if reconciled_meta.orphans:
@@ -322,63 +443,260 @@ def _add_common_args(p: argparse.ArgumentParser) -> None:
     )
     p.add_argument("--sample", type=int, default=25, help="How many example paths to print in preview (default: 25)")
 
-def _convert_rekordbox_location_to_path(loc: str) -> Optional[Path]:
+def _iter_rekordbox_tracks(xml_path: Path) -> Iterator[ET.Element]:
+    """
+    Yield TRACK elements one at a time, clearing each one once the caller is done with it
+    so peak memory stays around a single TRACK instead of the whole DOM.
+    """
+    if HAVE_LXML:
+        for _, track in ET.iterparse(str(xml_path), events=("end",), tag="TRACK"):
+            yield track
+            track.clear()
+            # Drop already processed siblings so the parent doesn't keep growing
+            while track.getprevious() is not None:
+                del track.getparent()[0]
+        return
+
+    # The stdlib parser has no tag filter or getparent(), so track the open elements ourselves
+    stack: list[ET.Element] = []
+    for event, elem in ET.iterparse(str(xml_path), events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        if elem.tag == "TRACK":
+            yield elem
+            elem.clear()
+            # Processed TRACKs are the only children we keep around, so drop them from the parent
+            if stack:
+                del stack[-1][:]
+
+def _scan_subtree(top: str) -> dict[str, str]:
+    found: dict[str, str] = {}
+    stack = [top]
+    while stack:
+        stack.extend(_scan_directory(stack.pop(), found))
+    return found
+
+def _scan_directory(dirpath: str, found: dict[str, str]) -> list[str]:
+    """
+    Add the audio files directly inside dirpath to found and return the subdirectories to visit.
+    Uses scandir instead of os.walk: DirEntry caches d_type, so telling directories from
+    files costs no extra stat per entry.
+
+    Classifies entries like os.walk(followlinks=False): symlinks to folders are neither
+    entered nor counted as files, and every other non-directory entry is a file candidate.
+    """
+    subdirs: list[str] = []
+    try:
+        it = os.scandir(dirpath)
+    except OSError:
+        # os.walk silently skipped unreadable directories, keep doing the same
+        return subdirs
+
+    with it:
+        try:
+            for entry in it:
+                name = entry.name
+                try:
+                    # d_type answers this without a stat, except for symlinks and
+                    # filesystems that report DT_UNKNOWN (network/FUSE mounts)
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if name not in DEFAULT_EXCLUDED_DIRNAMES and not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+
+                # Ignore macOS AppleDouble/Finder metadata files (plain string checks, no call per entry)
+                if name[:2] == _APPLEDOUBLE_PREFIX or name == ".DS_Store":
+                    continue
+
+                # Filter on the raw name first so non-audio files never pay for normalization.
+                # A name that is only the suffix (".mp3") is a hidden file, not audio (same as Path.suffix)
+                lower_name = name.lower()
+                if not lower_name.endswith(_AUDIO_SUFFIXES) or lower_name in _AUDIO_SUFFIXES:
+                    continue
+
+                path = entry.path
+                found[_normalize_unicode(path)] = path
+        except OSError:
+            # A read error mid-listing (e.g. EIO on a flaky external or NAS drive): like os.walk,
+            # give up on this folder but keep scanning the rest instead of aborting the run
+            pass
+    return subdirs
+
+def _convert_rekordbox_location_to_path(loc: str) -> Optional[str]:
     loc = (loc or "").strip()
     if not loc:
         return None
 
     # Already a normal POSIX path
     if loc.startswith("/"):
-        return Path(loc)
+        return loc
+
+    # Fast path for what Rekordbox actually writes (file://localhost/... or file:///...):
+    # the path starts at the first "/" after the host, no urlparse needed
+    if loc.startswith(_FILE_URI_PREFIX):
+        slash = loc.find("/", len(_FILE_URI_PREFIX))
+        if slash != -1:
+            return _unquote_if_needed(loc[slash:])
 
     # Rekordbox often stores file URIs
-    if loc.lower().startswith("file:"):
+    # Only the scheme needs lower-casing, the rest is compared by position
+    if loc[:5].lower() == "file:":
         # Handle odd "file:/localhost/..." by normalizing to "file://localhost/..."
-        if loc.lower().startswith("file:/") and not loc.lower().startswith("file://"):
+        if loc[5:6] == "/" and loc[6:7] != "/":
             loc = "file://" + loc[len("file:"):]
 
         parsed = urlparse(loc)
         if parsed.scheme.lower() == "file":
             path_str = unquote(parsed.path or "")
             if path_str:
-                return Path(path_str)
+                return path_str
+
+    return unquote(loc)
 
-    return Path(unquote(loc))
+def _unquote_if_needed(s: str) -> str:
+    return unquote(s) if "%" in s else s
 
 def _normalize_path(p: Path) -> Path:
     # Expand ~ first
     p = p.expanduser()
 
-    # Normalize unicode consistently (macOS commonly uses NFD on disk)
-    s = unicodedata.normalize("NFD", str(p))
-    p = Path(s)
+    # Normalize unicode consistently (macOS may hand back NFD names from disk)
+    p = Path(_normalize_unicode(str(p)))
 
     # Canonicalize absolute/symlinks best-effort
     return p.resolve(strict=False)
 
-def _unique_destination_path(dest: Path) -> Path:
+def _normalize_file_path(path: str, resolved_dirs: dict[str, str]) -> str:
+    """
+    Cheaper _normalize_path for bulk file paths: only the parent directory is resolved,
+    and its realpath is cached in resolved_dirs so each directory costs one realpath.
+    The file name itself is not followed, matching how scan_disk_files reports entries.
+    No Unicode normalization: the result is still a usable path, callers derive the key.
+    """
+    parent, name = os.path.split(os.path.abspath(os.path.expanduser(path)))
+    real_parent = resolved_dirs.get(parent)
+    if real_parent is None:
+        real_parent = resolved_dirs[parent] = os.path.realpath(parent)
+    return os.path.join(real_parent, name)
+
+def _normalize_unicode(s: str) -> str:
+    # Comparison key only, never a path to open: Linux stores names byte-for-byte, so an NFD
+    # name synced from macOS only exists under its NFD spelling.
+    # NFC rather than NFD: both sides only need to agree on a form, and NFC is what the XML
+    # and most filesystems usually hold already.
+    # ASCII and already-composed strings (the vast majority) skip the normalization entirely
+    if s.isascii() or unicodedata.is_normalized("NFC", s):
+        return s
+    return unicodedata.normalize("NFC", s)
+
+def _rename_or_move(src: Path, dst: Path) -> None:
+    """
+    os.rename when possible (a single syscall), copy + unlink only when crossing filesystems.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        _copy_across_devices(src, dst)
+
+def _copy_across_devices(src: Path, dst: Path) -> None:
     """
-    If dest exists, add " (1)", " (2)" etc before suffix.
+    What shutil.move ends up doing across filesystems, minus its isdir check and doomed
+    rename attempt. copyfile picks the platform zero-copy path (sendfile on Linux,
+    fcopyfile on macOS). Symlinks are recreated rather than followed, like shutil.move.
     """
-    if not dest.exists():
-        return dest
+    if os.path.islink(src):
+        # os.symlink won't replace an existing file such as a claimed placeholder
+        try:
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        os.symlink(os.readlink(src), dst)
+    else:
+        shutil.copyfile(src, dst)
+        shutil.copystat(src, dst)
+    os.unlink(src)
+
+def _read_manifest(manifest_path: Path) -> list[tuple[bytes, dict]]:
+    """
+    Read the whole manifest in one go and decode every non-empty line.
+    Returns (raw line, record) pairs so callers can write untouched lines back as-is.
+    """
+    with open(manifest_path, "rb") as mf:
+        data = mf.read()
+    lines = [line.strip() for line in data.splitlines()]
+    return [(line, _decode_manifest_record(line)) for line in lines if line]
+
+def _encode_manifest_record(record: dict) -> bytes:
+    if HAVE_ORJSON:
+        return orjson.dumps(record) + b"\n"
+
+    # The record schema is fixed, so write it by hand: only the two paths need JSON string
+    # escaping (encode_basestring is what json uses for ensure_ascii=False). About twice as
+    # fast as a generic encode, and the output matches orjson's compact form
+    dev = record["dev"]
+    ino = record["ino"]
+    return (
+        f'{{"ts":{record["ts"]},'
+        f'"src":{encode_basestring(record["src"])},'
+        f'"dst":{encode_basestring(record["dst"])},'
+        f'"size_bytes":{record["size_bytes"]},'
+        f'"mtime":{record["mtime"]!r},'
+        f'"dev":{"null" if dev is None else dev},'
+        f'"ino":{"null" if ino is None else ino}}}\n'
+    ).encode("utf-8")
+
+def _decode_manifest_record(line: bytes) -> dict:
+    # Both parsers accept UTF-8 bytes directly, no decode step needed
+    if HAVE_ORJSON:
+        return orjson.loads(line)
+    return json.loads(line)
+
+def _unique_destination_path(dest: Path, taken: set[str], *, claim: bool = False) -> Path:
+    """
+    If dest's name is taken, add " (1)", " (2)" etc before suffix.
+
+    taken holds the names already in the destination folder (one scandir up front), so
+    collisions are probed in memory instead of with an exists() per candidate. The chosen
+    name is added to it.
 
+    With claim=True the chosen name is also reserved by creating it empty with
+    O_CREAT | O_EXCL, so nothing else can take it before the move, and names the set
+    doesn't know about (e.g. case-insensitive matches) are still caught.
+    The caller is expected to replace the placeholder.
+    """
     stem = dest.stem
     suffix = dest.suffix
     parent = dest.parent
 
-    i = 1
+    name = dest.name
+    i = 0
     while True:
-        candidate = parent / f"{stem} ({i}){suffix}"
-        if not candidate.exists():
-            return candidate
-        i += 1
+        if name not in taken:
+            taken.add(name)
+            candidate = parent / name
+            if not claim:
+                return candidate
+            try:
+                fd = os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                pass
+            else:
+                os.close(fd)
+                return candidate
 
-def _should_ignore_filename(name: str) -> bool:
-    return name.startswith("._") or name == ".DS_Store"
+        i += 1
+        name = f"{stem} ({i}){suffix}"
 
-def main() -> int:
-    config = parse_command_line_args()
+def main(argv: Optional[list[str]] = None) -> int:
+    config = parse_command_line_args(argv)
 
     if config.cmd == RESTORE_COMMAND:
         stats = restore_from_manifest(manifest_path=config.manifest_path, dry_run=config.dry_run)
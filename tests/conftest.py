@@ -0,0 +1,53 @@
+"""
+Shared fixtures for the integration tests.
+
+Every test works inside its own tmp_path, so the suite can run in parallel with
+pytest-xdist (`pytest -n auto`).
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).parent.parent.resolve()
+
+# tmpfs: the suite creates many tiny files, none of which need to reach a disk
+_TMPFS_ROOT = "/dev/shm"
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    """
+    On Linux, keep pytest's temp dirs on tmpfs when it is writable.
+    An explicit --basetemp or PYTEST_DEBUG_TEMPROOT always wins.
+    """
+    if config.option.basetemp or "PYTEST_DEBUG_TEMPROOT" in os.environ:
+        return
+    if sys.platform.startswith("linux") and os.access(_TMPFS_ROOT, os.W_OK):
+        # Read lazily by pytest's TempPathFactory; it keeps its usual pytest-of-<user>/pytest-N layout and cleanup
+        os.environ["PYTEST_DEBUG_TEMPROOT"] = _TMPFS_ROOT
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _canonical_basetemp(tmp_path_factory: pytest.TempPathFactory) -> None:
+    """
+    Tests build paths from tmp_path and use them as-is, without resolve().
+    That only holds while the base temp dir is absolute and symlink-free.
+    """
+    basetemp = tmp_path_factory.getbasetemp()
+    assert basetemp.is_absolute() and basetemp == basetemp.resolve(), f"Non-canonical basetemp: {basetemp}"
+
+
+@pytest.fixture
+def scan_root(tmp_path: Path) -> Path:
+    """
+    The Music/ folder most tests scan, created inside the test's own tmp_path.
+    """
+    root = tmp_path / "Music"
+    root.mkdir()
+    # Parallel workers share the checkout, so nothing may ever be written under it
+    assert REPO_ROOT not in root.parents, f"Test folder must live outside the repo: {root}"
+    return root
@@ -1,35 +1,127 @@
 """
-Subprocess-based integration tests for file-cleanup.py CLI.
+Integration tests for the file-cleanup.py CLI.
 
-These tests invoke the CLI as a subprocess to ensure real-world behavior.
+These tests drive the CLI through its main() entry point, exactly as the command line would,
+but in-process: the script is imported once and each call captures stdout/stderr instead of
+paying for a fresh interpreter per invocation.
 Each test uses pytest's tmp_path fixture for complete isolation.
 """
 
 from __future__ import annotations
 
+import errno
+import importlib.util
+import io
 import json
+import os
 import re
-import subprocess
+import shutil
 import sys
+import unicodedata
+from contextlib import redirect_stderr, redirect_stdout
 from pathlib import Path
+from types import ModuleType, SimpleNamespace
 from urllib.parse import quote
 
+import pytest
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 REPO_ROOT = Path(__file__).parent.parent.resolve()
 CLI_SCRIPT = REPO_ROOT / "file-cleanup.py"
 
+_cli_module: ModuleType | None = None
+
+
+def _load_cli() -> ModuleType:
+    """
+    Import file-cleanup.py (not importable by name because of the dash) exactly once.
+    """
+    global _cli_module
+    if _cli_module is None:
+        spec = importlib.util.spec_from_file_location("file_cleanup", CLI_SCRIPT)
+        module = importlib.util.module_from_spec(spec)
+        # dataclasses look the module up in sys.modules while the class body is processed
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+        _cli_module = module
+    return _cli_module
+
+
+def run_cli(args: list[str]) -> SimpleNamespace:
+    """
+    Run file-cleanup.py's main() with the given arguments.
+    Returns a namespace with returncode, stdout and stderr (captured as strings).
+    All paths passed by the tests are absolute, so the working directory doesn't matter.
+    """
+    cli = _load_cli()
+    out = io.StringIO()
+    err = io.StringIO()
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            returncode = cli.main(args)
+        except SystemExit as e:
+            # Mirror the interpreter: a message goes to stderr with exit code 1
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+                returncode = 1
+            else:
+                returncode = e.code or 0
+    return SimpleNamespace(returncode=returncode, stdout=out.getvalue(), stderr=err.getvalue())
+
+
+# Fixed parts of a minimal Rekordbox XML export, pre-encoded; write_xml() fills in the tracks
+_XML_HEAD = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<DJ_PLAYLISTS Version="1.0.0">\n'
+    b'  <PRODUCT Name="rekordbox" Version="6.0.0" />\n'
+    b'  <COLLECTION Entries="'
+)
+_XML_TAIL = b"  </COLLECTION>\n</DJ_PLAYLISTS>\n"
+
+# Output patterns, compiled once for the whole module
+_ORPHAN_COUNT_RE = re.compile(r"Orphans[^0-9]*(\d+)")
+_COLLISION_RE = re.compile(r"dup \(\d+\)\.mp3")
+_DESTINATION_RE = re.compile(r"-> (.+)$", re.MULTILINE)
+
+# Sliced for sized test files instead of allocating a fresh buffer per file
+_ZEROS = bytes(8192)
+
+# Shape shared by several tests: two referenced files and two orphans in one folder
+ORPHAN_TREE_FILES = ("referenced_1.mp3", "referenced_2.wav", "orphan_1.mp3", "orphan_2.flac")
+
+
+@pytest.fixture(scope="session")
+def orphan_tree_template(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """
+    Build the ORPHAN_TREE_FILES folder once per session.
+    Tests clone it with clone_tree() instead of creating every file again.
+    """
+    root = tmp_path_factory.mktemp("orphan_tree_template")
+    touch_many([root / name for name in ORPHAN_TREE_FILES])
+    return root
+
+
+def clone_tree(template: Path, dst: Path) -> None:
+    """
+    Clone a template folder with hardlinks: metadata-only, no file data is copied.
+    Moving/renaming files in the clone never affects the template.
+    """
+    shutil.copytree(template, dst, copy_function=link_or_copy, dirs_exist_ok=True)
+
 
-def run_cli(args: list[str], cwd: Path | None = None) -> subprocess.CompletedProcess:
+def link_or_copy(src: str | Path, dst: str | Path) -> None:
     """
-    Run file-cleanup.py with the given arguments.
-    Returns CompletedProcess with stdout/stderr captured as strings.
+    Hardlink src to dst, falling back to a real copy where the filesystem can't link
+    (e.g. a basetemp on another device, or no hardlink support).
     """
-    cmd = [sys.executable, str(CLI_SCRIPT)] + args
-    return subprocess.run(
-        cmd,
-        cwd=cwd or REPO_ROOT,
-        capture_output=True,
-        text=True,
-    )
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
 
 
 def write_xml(xml_path: Path, locations: list[str]) -> None:
@@ -37,37 +129,66 @@ def write_xml(xml_path: Path, locations: list[str]) -> None:
     Write a minimal valid Rekordbox XML containing TRACK elements
     with Location attributes.
     """
-    tracks = "\n".join(
-        f'    <TRACK TrackID="{i}" Location="{loc}" />'
-        for i, loc in enumerate(locations, start=1)
-    )
-    content = f"""<?xml version="1.0" encoding="UTF-8"?>
-<DJ_PLAYLISTS Version="1.0.0">
-  <PRODUCT Name="rekordbox" Version="6.0.0" />
-  <COLLECTION Entries="{len(locations)}">
-{tracks}
-  </COLLECTION>
-</DJ_PLAYLISTS>
-"""
-    xml_path.write_text(content, encoding="utf-8")
+    buf = bytearray(_XML_HEAD)
+    buf += b'%d">\n' % len(locations)
+    for i, loc in enumerate(locations, start=1):
+        buf += f'    <TRACK TrackID="{i}" Location="{loc}" />\n'.encode("utf-8")
+    buf += _XML_TAIL
+    xml_path.write_bytes(buf)
+
+
+def _orphan_count(text: str) -> int | None:
+    """
+    The orphan count from the CLI's summary line, or None if there is none.
+    """
+    m = _ORPHAN_COUNT_RE.search(text)
+    return int(m.group(1)) if m else None
 
 
-def touch_audio(path: Path, size: int = 16) -> None:
+def touch_audio(path: Path, size: int = 0) -> None:
     """
-    Create a file with some bytes so file size > 0.
-    Creates parent directories as needed.
+    Create an audio file, creating parent directories as needed.
+    The scanner doesn't look at sizes, so files are empty unless a size is
+    given (only where files must differ, e.g. collisions).
     """
     path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_bytes(b"\x00" * size)
+    _write_zeros(path, size)
+
+
+def touch_many(paths: list[Path], size: int = 0) -> None:
+    """
+    Create several files like touch_audio(), making each parent directory only once.
+    """
+    for parent in {p.parent for p in paths}:
+        parent.mkdir(parents=True, exist_ok=True)
+    for path in paths:
+        _write_zeros(path, size)
+
+
+def _write_zeros(path: Path, size: int) -> None:
+    # Raw fd calls: no Path/file-object layers; an empty file is just the create
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if size:
+            os.write(fd, _ZEROS[:size] if size <= len(_ZEROS) else bytes(size))
+    finally:
+        os.close(fd)
+
+
+def read_manifest(path: Path) -> list[dict]:
+    """
+    Parse every non-blank line of a JSONL manifest from a single bytes read.
+    """
+    return [_json_loads(line) for line in path.read_bytes().splitlines() if line.strip()]
 
 
 def path_to_file_uri(path: Path) -> str:
     """
-    Convert a Path to a file://localhost/... URI with percent encoding.
+    Convert an absolute Path to a file://localhost/... URI with percent encoding.
     Spaces become %20, & becomes %26, etc.
+    The path is used as given: test paths are built from tmp_path, which pytest already resolves.
     """
-    abs_path = str(path.resolve())
-    encoded = quote(abs_path, safe="/")
+    encoded = quote(os.fspath(path), safe="/")
     return f"file://localhost{encoded}"
 
 
@@ -77,19 +198,15 @@ class TestPreviewCountsBasic:
     Verify preview command correctly counts orphans, referenced files, and ignores macOS metadata.
     """
 
-    def test_preview_counts_basic(self, tmp_path: Path) -> None:
-        scan_root = tmp_path / "Music"
-        scan_root.mkdir()
+    def test_preview_counts_basic(self, tmp_path: Path, scan_root: Path, orphan_tree_template: Path) -> None:
+        clone_tree(orphan_tree_template, scan_root)
 
         referenced_1 = scan_root / "referenced_1.mp3"
         referenced_2 = scan_root / "referenced_2.wav"
-        orphan_1 = scan_root / "orphan_1.mp3"
-        orphan_2 = scan_root / "orphan_2.flac"
         ignored_1 = scan_root / "._junk.mp3"
         ignored_2 = scan_root / ".DS_Store"
 
-        for f in [referenced_1, referenced_2, orphan_1, orphan_2, ignored_1, ignored_2]:
-            touch_audio(f)
+        touch_many([ignored_1, ignored_2])
 
         xml_path = tmp_path / "rekordbox.xml"
         write_xml(xml_path, [str(referenced_1), str(referenced_2)])
@@ -104,7 +221,7 @@ class TestPreviewCountsBasic:
 
         stdout = result.stdout
 
-        assert re.search(r"Orphans.*2", stdout), f"Expected 'Orphans...2' in output:\n{stdout}"
+        assert _orphan_count(stdout) == 2, f"Expected 2 orphans in output:\n{stdout}"
         assert "Rekordbox collection records (XML): 2" in stdout, f"Expected XML count 2:\n{stdout}"
         assert "Scanned disk files: 4" in stdout, f"Expected scanned files 4 (ignored files not counted):\n{stdout}"
 
@@ -115,10 +232,7 @@ class TestMoveAndManifestCreated:
     Verify move command moves orphans and creates manifest.
     """
 
-    def test_move_dry_run_does_not_move(self, tmp_path: Path) -> None:
-        scan_root = tmp_path / "Music"
-        scan_root.mkdir()
-
+    def test_move_dry_run_does_not_move(self, tmp_path: Path, scan_root: Path) -> None:
         referenced = scan_root / "referenced.mp3"
         orphan = scan_root / "orphan.mp3"
         touch_audio(referenced)
@@ -138,22 +252,20 @@ class TestMoveAndManifestCreated:
 
         orphans_dir = scan_root / "_Rekordbox_Orphans"
         manifest = orphans_dir / "orphans_manifest.jsonl"
-        if manifest.exists():
+        try:
             content = manifest.read_text().strip()
-            assert content == "", "Manifest should be empty in dry-run"
+        except FileNotFoundError:
+            content = ""
+        assert content == "", "Manifest should be empty in dry-run"
 
-    def test_move_creates_manifest_and_moves_files(self, tmp_path: Path) -> None:
-        scan_root = tmp_path / "Music"
-        scan_root.mkdir()
+    def test_move_creates_manifest_and_moves_files(self, tmp_path: Path, scan_root: Path, orphan_tree_template: Path) -> None:
+        clone_tree(orphan_tree_template, scan_root)
 
         referenced_1 = scan_root / "referenced_1.mp3"
         referenced_2 = scan_root / "referenced_2.wav"
         orphan_1 = scan_root / "orphan_1.mp3"
         orphan_2 = scan_root / "orphan_2.flac"
 
-        for f in [referenced_1, referenced_2, orphan_1, orphan_2]:
-            touch_audio(f)
-
         xml_path = tmp_path / "rekordbox.xml"
         write_xml(xml_path, [str(referenced_1), str(referenced_2)])
 
@@ -179,15 +291,81 @@ class TestMoveAndManifestCreated:
         manifest = orphans_dir / "orphans_manifest.jsonl"
         assert manifest.exists(), "Manifest should exist"
 
-        lines = [line for line in manifest.read_text().splitlines() if line.strip()]
-        assert len(lines) == 2, f"Manifest should have 2 lines, got {len(lines)}"
+        records = read_manifest(manifest)
+        assert len(records) == 2, f"Manifest should have 2 records, got {len(records)}"
 
         required_keys = {"ts", "src", "dst", "size_bytes", "mtime", "dev", "ino"}
-        for line in lines:
-            record = json.loads(line)
+        for record in records:
             assert required_keys <= set(record.keys()), f"Missing keys in record: {record.keys()}"
             assert "_Rekordbox_Orphans" in record["dst"], f"dst should point to orphans dir: {record['dst']}"
 
+    def test_move_falls_back_to_copy_on_cross_device_rename(self, tmp_path: Path, scan_root: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        """Test an EXDEV rename (other filesystem, bind mount) still moves files and symlinks."""
+
+        referenced = scan_root / "referenced.mp3"
+        orphan = scan_root / "orphan.mp3"
+        touch_many([referenced, orphan], size=32)
+        target = tmp_path / "elsewhere.mp3"
+        touch_audio(target)
+        link = scan_root / "link.mp3"
+        link.symlink_to(target)
+
+        xml_path = tmp_path / "rekordbox.xml"
+        write_xml(xml_path, [str(referenced)])
+
+        def cross_device_replace(src, dst):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), str(src), str(dst))
+
+        monkeypatch.setattr(os, "replace", cross_device_replace)
+        result = run_cli([
+            "move",
+            "--rekordbox-xml", str(xml_path),
+            "--scan-root", str(scan_root),
+        ])
+        monkeypatch.undo()
+
+        assert result.returncode == 0, f"CLI failed: {result.stderr}"
+        assert "[ERROR]" not in result.stdout, result.stdout
+
+        orphans_dir = scan_root / "_Rekordbox_Orphans"
+        assert not orphan.exists() and not link.is_symlink(), "Both orphans should be moved"
+        assert (orphans_dir / "orphan.mp3").stat().st_size == 32, "File contents should be copied"
+        assert os.readlink(orphans_dir / "link.mp3") == str(target), "Symlink should be recreated, not followed"
+        assert target.exists()
+        assert len(read_manifest(orphans_dir / "orphans_manifest.jsonl")) == 2
+
+    def test_interrupt_right_after_move_keeps_file_and_record(self, tmp_path: Path, scan_root: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        """Test a Ctrl-C landing just after the rename neither deletes the moved file nor loses its record."""
+
+        referenced = scan_root / "referenced.mp3"
+        orphan = scan_root / "orphan.mp3"
+        touch_many([referenced, orphan], size=32)
+
+        xml_path = tmp_path / "rekordbox.xml"
+        write_xml(xml_path, [str(referenced)])
+
+        real_replace = os.replace
+
+        def replace_then_interrupt(src, dst):
+            real_replace(src, dst)
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(os, "replace", replace_then_interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            run_cli([
+                "move",
+                "--rekordbox-xml", str(xml_path),
+                "--scan-root", str(scan_root),
+            ])
+        monkeypatch.undo()
+
+        orphans_dir = scan_root / "_Rekordbox_Orphans"
+        moved = orphans_dir / "orphan.mp3"
+        assert not orphan.exists()
+        assert moved.stat().st_size == 32, "The moved file must survive the interrupt"
+        records = read_manifest(orphans_dir / "orphans_manifest.jsonl")
+        assert [(r["src"], r["dst"]) for r in records] == [(str(orphan), str(moved))]
+
 
 class TestRestoreRoundTrip:
     """
@@ -195,10 +373,7 @@ class TestRestoreRoundTrip:
     Verify restore command moves files back and handles manifest correctly.
     """
 
-    def test_restore_round_trip(self, tmp_path: Path) -> None:
-        scan_root = tmp_path / "Music"
-        scan_root.mkdir()
-
+    def test_restore_round_trip(self, tmp_path: Path, scan_root: Path) -> None:
         referenced = scan_root / "referenced.mp3"
         orphan_1 = scan_root / "orphan_1.mp3"
         orphan_2 = scan_root / "orphan_2.flac"
@@ -207,9 +382,6 @@ class TestRestoreRoundTrip:
         touch_audio(orphan_1)
         touch_audio(orphan_2)
 
-        original_orphan_1 = orphan_1.resolve()
-        original_orphan_2 = orphan_2.resolve()
-
         xml_path = tmp_path / "rekordbox.xml"
         write_xml(xml_path, [str(referenced)])
 
@@ -230,18 +402,22 @@ class TestRestoreRoundTrip:
         ])
         assert restore_result.returncode == 0, f"Restore failed: {restore_result.stderr}"
 
-        assert original_orphan_1.exists(), "orphan_1 should be restored"
-        assert original_orphan_2.exists(), "orphan_2 should be restored"
+        assert orphan_1.exists(), "orphan_1 should be restored"
+        assert orphan_2.exists(), "orphan_2 should be restored"
 
         orphans_dir = scan_root / "_Rekordbox_Orphans"
-        if orphans_dir.exists():
+        try:
             orphan_files = [f for f in orphans_dir.iterdir() if f.name != "orphans_manifest.jsonl"]
-            assert len(orphan_files) == 0, f"Orphans dir should be empty after restore: {orphan_files}"
+        except FileNotFoundError:
+            orphan_files = []
+        assert len(orphan_files) == 0, f"Orphans dir should be empty after restore: {orphan_files}"
 
         manifest = orphans_dir / "orphans_manifest.jsonl"
-        if manifest.exists():
+        try:
             content = manifest.read_text().strip()
-            assert content == "", f"Manifest should be empty or deleted: {content}"
+        except FileNotFoundError:
+            content = ""
+        assert content == "", f"Manifest should be empty or deleted: {content}"
 
         preview_result = run_cli([
             "preview",
@@ -250,19 +426,89 @@ class TestRestoreRoundTrip:
         ])
         assert preview_result.returncode == 0
 
-        assert re.search(r"Orphans.*2", preview_result.stdout), \
+        assert _orphan_count(preview_result.stdout) == 2, \
             f"After restore, orphan count should be 2 again:\n{preview_result.stdout}"
 
 
+    def test_restore_skips_missing_and_recreates_folders(self, tmp_path: Path, scan_root: Path) -> None:
+        referenced = scan_root / "referenced.mp3"
+        deleted = scan_root / "deleted.mp3"
+        nested = scan_root / "Album" / "nested.mp3"
+
+        touch_audio(referenced)
+        touch_audio(deleted)
+        touch_audio(nested)
+
+        xml_path = tmp_path / "rekordbox.xml"
+        write_xml(xml_path, [str(referenced)])
+
+        move_result = run_cli([
+            "move",
+            "--rekordbox-xml", str(xml_path),
+            "--scan-root", str(scan_root),
+        ])
+        assert move_result.returncode == 0, f"Move failed: {move_result.stderr}"
+
+        orphans_dir = scan_root / "_Rekordbox_Orphans"
+        (orphans_dir / "deleted.mp3").unlink()
+        (scan_root / "Album").rmdir()
+
+        restore_result = run_cli([
+            "restore",
+            "--rekordbox-xml", str(xml_path),
+            "--scan-root", str(scan_root),
+        ])
+        assert restore_result.returncode == 0, f"Restore failed: {restore_result.stderr}"
+
+        assert nested.exists(), "Original folder should be recreated on restore"
+        assert not deleted.exists()
+        assert "'skipped_missing': 1" in restore_result.stdout, restore_result.stdout
+        assert not (orphans_dir / "orphans_manifest.jsonl").exists(), "Manifest should be cleared"
+
+    def test_restore_keeps_record_when_retry_fails(self, tmp_path: Path, scan_root: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        """Test a file still in quarantine keeps its manifest line when the rename keeps failing."""
+
+        referenced = scan_root / "referenced.mp3"
+        orphan = scan_root / "orphan.mp3"
+        touch_many([referenced, orphan])
+
+        xml_path = tmp_path / "rekordbox.xml"
+        write_xml(xml_path, [str(referenced)])
+
+        move_result = run_cli([
+            "move",
+            "--rekordbox-xml", str(xml_path),
+            "--scan-root", str(scan_root),
+        ])
+        assert move_result.returncode == 0, f"Move failed: {move_result.stderr}"
+
+        def rename_not_found(src, dst):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), str(src), str(dst))
+
+        monkeypatch.setattr(os, "rename", rename_not_found)
+        restore_result = run_cli([
+            "restore",
+            "--rekordbox-xml", str(xml_path),
+            "--scan-root", str(scan_root),
+        ])
+        monkeypatch.undo()
+
+        assert restore_result.returncode == 0, f"Restore failed: {restore_result.stderr}"
+        assert "'errors': 1" in restore_result.stdout and "'skipped_missing': 0" in restore_result.stdout, restore_result.stdout
+
+        orphans_dir = scan_root / "_Rekordbox_Orphans"
+        assert (orphans_dir / "orphan.mp3").exists()
+        records = read_manifest(orphans_dir / "orphans_manifest.jsonl")
+        assert [r["src"] for r in records] == [str(orphan)], "The quarantined file must stay in the manifest"
+
+
 class TestFilenameCollisionFlatMove:
     """
     Test D: filename_collision_flat_move
     Verify collision handling when multiple files have the same basename.
     """
 
-    def test_filename_collision_flat_move(self, tmp_path: Path) -> None:
-        scan_root = tmp_path / "Music"
-
+    def test_filename_collision_flat_move(self, tmp_path: Path, scan_root: Path) -> None:
         subdir_a = scan_root / "A"
         subdir_b = scan_root / "B"
         subdir_a.mkdir(parents=True)
@@ -292,29 +538,48 @@ class TestFilenameCollisionFlatMove:
         assert len(moved_names) == 2, f"Should have 2 moved files: {moved_names}"
         assert "dup.mp3" in moved_names, f"Original dup.mp3 should exist: {moved_names}"
 
-        collision_pattern = re.compile(r"dup \(\d+\)\.mp3")
-        collision_files = [n for n in moved_names if collision_pattern.match(n)]
+        collision_files = [n for n in moved_names if _COLLISION_RE.match(n)]
         assert len(collision_files) == 1, f"Should have one collision-renamed file: {moved_names}"
 
         manifest = orphans_dir / "orphans_manifest.jsonl"
-        lines = [line for line in manifest.read_text().splitlines() if line.strip()]
-        assert len(lines) == 2, f"Manifest should have 2 lines: {len(lines)}"
+        records = read_manifest(manifest)
+        assert len(records) == 2, f"Manifest should have 2 records: {len(records)}"
 
-        dst_values = [json.loads(line)["dst"] for line in lines]
+        dst_values = [record["dst"] for record in records]
         dst_names = [Path(d).name for d in dst_values]
         assert sorted(dst_names) == sorted(moved_names), \
             f"Manifest dst values should match actual files: {dst_names} vs {moved_names}"
 
 
+    def test_filename_collision_dry_run_reports_distinct_destinations(self, tmp_path: Path, scan_root: Path) -> None:
+        touch_audio(scan_root / "A" / "dup.mp3")
+        touch_audio(scan_root / "B" / "dup.mp3")
+
+        xml_path = tmp_path / "rekordbox.xml"
+        write_xml(xml_path, [])
+
+        result = run_cli([
+            "move", "--dry-run",
+            "--rekordbox-xml", str(xml_path),
+            "--scan-root", str(scan_root),
+        ])
+        assert result.returncode == 0, f"CLI failed: {result.stderr}"
+
+        destinations = _DESTINATION_RE.findall(result.stdout)
+        assert sorted(Path(d).name for d in destinations) == ["dup (1).mp3", "dup.mp3"], result.stdout
+
+        orphans_dir = scan_root / "_Rekordbox_Orphans"
+        moved_files = [f for f in orphans_dir.iterdir() if f.name != "orphans_manifest.jsonl"]
+        assert moved_files == [], f"Dry run should not create anything in the orphans dir: {moved_files}"
+
+
 class TestFileURIAndPercentDecode:
     """
     Test E: file_uri_and_percent_decode
     Verify handling of file:// URIs with percent-encoded special characters.
     """
 
-    def test_file_uri_and_percent_decode(self, tmp_path: Path) -> None:
-        scan_root = tmp_path / "Music"
-
+    def test_file_uri_and_percent_decode(self, tmp_path: Path, scan_root: Path) -> None:
         special_dir = scan_root / "House & Techno"
         special_dir.mkdir(parents=True)
 
@@ -337,70 +602,244 @@ class TestFileURIAndPercentDecode:
         assert result.returncode == 0, f"CLI failed: {result.stderr}"
 
         stdout = result.stdout
-        assert re.search(r"Orphans.*0", stdout), \
+        assert _orphan_count(stdout) == 0, \
             f"Orphan count should be 0 (file recognized as referenced):\n{stdout}"
         assert "Collection references missing on disk: 0" in stdout, \
             f"Missing on disk should be 0:\n{stdout}"
 
 
-class TestEdgeCases:
-    """Additional edge case tests for robustness."""
+_AUDIO_EXTENSIONS = ("mp3", "wav", "aiff", "aif", "flac", "m4a")
+
+# Edge-case scenarios sharing one test body. Paths are relative to tmp_path; every scan root is created.
+#   files:   files to create
+#   refs:    collection locations written to the XML
+#   command: CLI command to run (default "preview")
+#   roots:   scan roots (default ["Music"])
+#   stdout:  substrings expected in the output
+#   stdout_ci: substrings expected in the output, ignoring case
+#   orphans: expected orphan count in the summary line, if printed
+#   moved:   files that must end up in Music/_Rekordbox_Orphans
+_EDGE_CASES = [
+    pytest.param(
+        dict(files=["Music/orphan.mp3"], refs=[],
+             stdout=["Rekordbox collection records (XML): 0"], orphans=1),
+        id="empty_collection",
+    ),
+    pytest.param(
+        dict(files=["Music/referenced.mp3"], refs=["Music/referenced.mp3"], command="move",
+             stdout_ci=["no orphans found"]),
+        id="no_orphans",
+    ),
+    pytest.param(
+        dict(files=["Music/Genre/Artist/Album/track.mp3", "Music/Genre/Artist/Album/bonus.flac"],
+             refs=["Music/Genre/Artist/Album/track.mp3"], command="move",
+             moved=["Music/Genre/Artist/Album/bonus.flac"]),
+        id="nested_directories",
+    ),
+    pytest.param(
+        dict(files=["Music1/track1.mp3", "Music2/track2.mp3", "Music1/orphan1.mp3", "Music2/orphan2.mp3"],
+             refs=["Music1/track1.mp3", "Music2/track2.mp3"], roots=["Music1", "Music2"],
+             stdout=["Scanned disk files: 4"], orphans=2),
+        id="multiple_scan_roots",
+    ),
+    pytest.param(
+        dict(files=[f"Music/track.{ext}" for ext in _AUDIO_EXTENSIONS] + ["Music/track.ogg"], refs=[],
+             stdout=[f"Scanned disk files: {len(_AUDIO_EXTENSIONS)}"]),
+        id="all_audio_extensions",
+    ),
+]
+
+
+# A trimmed-down real export: TRACKs with child elements, plus playlists that reference
+# tracks by Key only. Only COLLECTION TRACKs carry a Location
+_REKORDBOX_SHAPED_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<DJ_PLAYLISTS Version="1.0.0">
+  <PRODUCT Name="rekordbox" Version="6.8.5" Company="AlphaTheta"/>
+  <COLLECTION Entries="3">
+    <TRACK TrackID="1" Name="One" Kind="MP3 File" Location="{one}">
+      <TEMPO Inizio="0.025" Bpm="124.00" Metro="4/4" Battito="1"/>
+      <POSITION_MARK Name="" Type="0" Start="0.025" Num="-1"/>
+    </TRACK>
+    <TRACK TrackID="2" Name="Two" Kind="WAV File" Location="{two}">
+      <TEMPO Inizio="0.100" Bpm="128.00" Metro="4/4" Battito="1"/>
+      <TEMPO Inizio="60.100" Bpm="128.00" Metro="4/4" Battito="1"/>
+      <POSITION_MARK Name="Drop" Type="0" Start="32.100" Num="0" Red="40" Green="226" Blue="20"/>
+    </TRACK>
+    <TRACK TrackID="3" Name="Gone" Kind="MP3 File" Location="{gone}"/>
+  </COLLECTION>
+  <PLAYLISTS>
+    <NODE Type="0" Name="ROOT" Count="1">
+      <NODE Name="Friday" Type="1" KeyType="0" Entries="2">
+        <TRACK Key="1"/>
+        <TRACK Key="2"/>
+      </NODE>
+    </NODE>
+  </PLAYLISTS>
+</DJ_PLAYLISTS>
+"""
+
+
+def _use_stdlib_xml(cli: ModuleType, monkeypatch: pytest.MonkeyPatch) -> None:
+    import xml.etree.ElementTree as stdlib_et
+    monkeypatch.setattr(cli, "ET", stdlib_et)
+    monkeypatch.setattr(cli, "HAVE_LXML", False)
 
-    def test_empty_collection(self, tmp_path: Path) -> None:
-        """Test with no tracks in XML."""
-        scan_root = tmp_path / "Music"
-        scan_root.mkdir()
 
+def _use_lxml(cli: ModuleType, monkeypatch: pytest.MonkeyPatch) -> None:
+    lxml_etree = pytest.importorskip("lxml.etree")
+    monkeypatch.setattr(cli, "ET", lxml_etree)
+    monkeypatch.setattr(cli, "HAVE_LXML", True)
+
+
+class TestXMLBackends:
+    """
+    The XML is parsed with lxml when installed and the stdlib otherwise; each path has its own
+    streaming/pruning code, so run both regardless of what this environment has.
+    """
+
+    @pytest.mark.parametrize("use_backend", [_use_stdlib_xml, _use_lxml], ids=["stdlib", "lxml"])
+    def test_rekordbox_shaped_export(self, tmp_path: Path, scan_root: Path, monkeypatch: pytest.MonkeyPatch, use_backend) -> None:
+        one = scan_root / "Album" / "One.mp3"
+        two = scan_root / "Two & Co.wav"
+        gone = scan_root / "Gone.mp3"
         orphan = scan_root / "orphan.mp3"
-        touch_audio(orphan)
+        touch_many([one, two, orphan])
 
         xml_path = tmp_path / "rekordbox.xml"
-        write_xml(xml_path, [])
+        xml_path.write_text(
+            _REKORDBOX_SHAPED_XML.format(one=path_to_file_uri(one), two=path_to_file_uri(two), gone=path_to_file_uri(gone)),
+            encoding="utf-8",
+        )
+
+        cli = _load_cli()
+        use_backend(cli, monkeypatch)
+        assert set(cli.scan_rekordbox_xml(xml_path).values()) == {str(one), str(two), str(gone)}
 
         result = run_cli([
             "preview",
             "--rekordbox-xml", str(xml_path),
             "--scan-root", str(scan_root),
         ])
+        assert result.returncode == 0, f"CLI failed: {result.stderr}"
+        assert "Rekordbox collection records (XML): 3" in result.stdout, result.stdout
+        assert _orphan_count(result.stdout) == 1
+        assert "Collection references missing on disk: 1" in result.stdout, result.stdout
 
-        assert result.returncode == 0
-        assert "Rekordbox collection records (XML): 0" in result.stdout
-        assert re.search(r"Orphans.*1", result.stdout)
 
-    def test_no_orphans(self, tmp_path: Path) -> None:
-        """Test when all files are referenced."""
-        scan_root = tmp_path / "Music"
-        scan_root.mkdir()
+class TestManifestEncoding:
+    """
+    Without orjson, manifest lines are formatted by hand; they must still be exactly the JSON record.
+    """
 
-        referenced = scan_root / "referenced.mp3"
+    @pytest.mark.parametrize("path", [
+        '/Music/Say "Hello".mp3',
+        "/Music/back\\slash\\track.mp3",
+        "/Music/tab\tnew\nline\x00bell\x07.mp3",
+        "/Music/Beyoncé – 東京 🎧.flac",
+        "/Music/\u2028separator\u2029.wav",
+    ], ids=["quotes", "backslashes", "control_chars", "non_ascii", "line_separators"])
+    def test_fallback_line_is_the_json_record(self, monkeypatch: pytest.MonkeyPatch, path: str) -> None:
+        cli = _load_cli()
+        monkeypatch.setattr(cli, "HAVE_ORJSON", False)
+
+        record = {
+            "ts": 1700000000,
+            "src": path,
+            "dst": "/Music/_Rekordbox_Orphans/" + path.rsplit("/", 1)[-1],
+            "size_bytes": 123456789,
+            "mtime": 1699999999.123456,
+            "dev": 66306,
+            "ino": None,
+        }
+        line = cli._encode_manifest_record(record)
+
+        assert line.endswith(b"\n") and line.count(b"\n") == 1, line
+        assert json.loads(line) == record
+        assert cli._decode_manifest_record(line.strip()) == record
+
+
+class TestEdgeCases:
+    """Additional edge case tests for robustness."""
+
+    @pytest.mark.parametrize("case", _EDGE_CASES)
+    def test_edge_case(self, tmp_path: Path, case: dict) -> None:
+        roots = [tmp_path / root for root in case.get("roots", ["Music"])]
+        for root in roots:
+            root.mkdir()
+        touch_many([tmp_path / f for f in case["files"]])
+
+        xml_path = tmp_path / "rekordbox.xml"
+        write_xml(xml_path, [str(tmp_path / ref) for ref in case["refs"]])
+
+        args = [case.get("command", "preview"), "--rekordbox-xml", str(xml_path)]
+        for root in roots:
+            args += ["--scan-root", str(root)]
+        result = run_cli(args)
+
+        assert result.returncode == 0, f"CLI failed: {result.stderr}"
+        for text in case.get("stdout", []):
+            assert text in result.stdout, f"Expected {text!r} in output:\n{result.stdout}"
+        for text in case.get("stdout_ci", []):
+            assert text.lower() in result.stdout.lower(), f"Expected {text!r} in output:\n{result.stdout}"
+        if "orphans" in case:
+            assert _orphan_count(result.stdout) == case["orphans"]
+
+        orphans_dir = tmp_path / "Music" / "_Rekordbox_Orphans"
+        for rel in case.get("moved", []):
+            assert not (tmp_path / rel).exists(), f"{rel} should have been moved"
+            assert (orphans_dir / Path(rel).name).exists(), f"{rel} should be in the orphans dir"
+
+    def test_reference_through_symlinked_folder(self, tmp_path: Path, scan_root: Path) -> None:
+        """Test a collection path that goes through a symlinked folder still matches the scanned file."""
+
+        referenced = scan_root / "Album" / "track.mp3"
         touch_audio(referenced)
 
+        link = tmp_path / "Linked"
+        link.symlink_to(scan_root / "Album", target_is_directory=True)
+
         xml_path = tmp_path / "rekordbox.xml"
-        write_xml(xml_path, [str(referenced)])
+        write_xml(xml_path, [str(link / "track.mp3")])
 
         result = run_cli([
-            "move",
+            "preview",
             "--rekordbox-xml", str(xml_path),
             "--scan-root", str(scan_root),
         ])
 
         assert result.returncode == 0
-        assert "no orphans found" in result.stdout.lower()
+        assert _orphan_count(result.stdout) == 0
+        assert "Collection references missing on disk: 0" in result.stdout
 
-    def test_nested_directories(self, tmp_path: Path) -> None:
-        """Test files in deeply nested directories."""
-        scan_root = tmp_path / "Music"
+    def test_symlinked_folder_is_not_scanned_as_file(self, tmp_path: Path, scan_root: Path) -> None:
+        """Test a symlink to a folder is neither entered nor counted, even with an audio-like name."""
 
-        deep_dir = scan_root / "Genre" / "Artist" / "Album"
-        deep_dir.mkdir(parents=True)
+        touch_audio(tmp_path / "Real" / "track.mp3")
+        (scan_root / "Live Set.mp3").symlink_to(tmp_path / "Real", target_is_directory=True)
+        touch_audio(scan_root / "orphan.mp3")
 
-        referenced = deep_dir / "track.mp3"
-        orphan = deep_dir / "bonus.flac"
-        touch_audio(referenced)
+        xml_path = tmp_path / "rekordbox.xml"
+        write_xml(xml_path, [])
+
+        result = run_cli([
+            "preview",
+            "--rekordbox-xml", str(xml_path),
+            "--scan-root", str(scan_root),
+        ])
+
+        assert result.returncode == 0, f"CLI failed: {result.stderr}"
+        assert "Scanned disk files: 1" in result.stdout, result.stdout
+
+    def test_symlink_loop_is_reported_without_aborting_move(self, tmp_path: Path, scan_root: Path) -> None:
+        """Test a self-referencing symlink named like audio is counted as an error and the other orphans still move."""
+
+        loop = scan_root / "loop.mp3"
+        loop.symlink_to(loop)
+        orphan = scan_root / "a.mp3"
         touch_audio(orphan)
 
         xml_path = tmp_path / "rekordbox.xml"
-        write_xml(xml_path, [str(referenced)])
+        write_xml(xml_path, [])
 
         result = run_cli([
             "move",
@@ -408,64 +847,140 @@ class TestEdgeCases:
             "--scan-root", str(scan_root),
         ])
 
-        assert result.returncode == 0
+        assert result.returncode == 0, f"CLI failed: {result.stderr}"
+        assert "'moved': 1" in result.stdout and "'errors': 1" in result.stdout, result.stdout
         assert not orphan.exists()
+        assert loop.is_symlink(), "The broken link is left where it was"
 
-        orphans_dir = scan_root / "_Rekordbox_Orphans"
-        assert (orphans_dir / "bonus.flac").exists()
+    def test_read_error_in_one_folder_does_not_abort_scan(self, tmp_path: Path, scan_root: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        """Test an I/O error while listing one folder skips it and keeps scanning the others."""
+
+        flaky = scan_root / "Flaky"
+        touch_many([flaky / "a.mp3", scan_root / "Good" / "b.mp3", scan_root / "c.mp3"])
+
+        xml_path = tmp_path / "rekordbox.xml"
+        write_xml(xml_path, [])
 
-    def test_multiple_scan_roots(self, tmp_path: Path) -> None:
-        """Test with multiple scan roots."""
-        root1 = tmp_path / "Music1"
-        root2 = tmp_path / "Music2"
-        root1.mkdir()
-        root2.mkdir()
+        real_scandir = os.scandir
 
-        ref1 = root1 / "track1.mp3"
-        ref2 = root2 / "track2.mp3"
-        orphan1 = root1 / "orphan1.mp3"
-        orphan2 = root2 / "orphan2.mp3"
+        class FailingListing:
+            def __init__(self, path):
+                self._it = real_scandir(path)
 
-        for f in [ref1, ref2, orphan1, orphan2]:
-            touch_audio(f)
+            def __enter__(self):
+                return self
 
-        xml_path = tmp_path / "rekordbox.xml"
-        write_xml(xml_path, [str(ref1), str(ref2)])
+            def __exit__(self, *exc):
+                self._it.close()
+
+            def __iter__(self):
+                raise OSError(errno.EIO, os.strerror(errno.EIO))
+                yield
 
+        def flaky_scandir(path="."):
+            return FailingListing(path) if os.fspath(path) == str(flaky) else real_scandir(path)
+
+        monkeypatch.setattr(os, "scandir", flaky_scandir)
         result = run_cli([
             "preview",
             "--rekordbox-xml", str(xml_path),
-            "--scan-root", str(root1),
-            "--scan-root", str(root2),
+            "--scan-root", str(scan_root),
         ])
+        monkeypatch.undo()
 
-        assert result.returncode == 0
-        assert "Scanned disk files: 4" in result.stdout
-        assert re.search(r"Orphans.*2", result.stdout)
-
-    def test_all_audio_extensions(self, tmp_path: Path) -> None:
-        """Test all supported audio extensions are scanned."""
-        scan_root = tmp_path / "Music"
-        scan_root.mkdir()
+        assert result.returncode == 0, f"CLI failed: {result.stderr}"
+        assert "Scanned disk files: 2" in result.stdout, result.stdout
 
-        extensions = ["mp3", "wav", "aiff", "aif", "flac", "m4a"]
-        files = []
-        for ext in extensions:
-            f = scan_root / f"track.{ext}"
-            touch_audio(f)
-            files.append(f)
+    def test_unicode_normalization_forms_match(self, tmp_path: Path, scan_root: Path) -> None:
+        """Test composed (NFC) file names match decomposed (NFD) collection paths and still move."""
 
-        unsupported = scan_root / "track.ogg"
-        touch_audio(unsupported)
+        referenced = scan_root / unicodedata.normalize("NFC", "Café Del Mar.mp3")
+        orphan = scan_root / unicodedata.normalize("NFC", "Beyoncé.mp3")
+        touch_audio(referenced)
+        touch_audio(orphan)
 
         xml_path = tmp_path / "rekordbox.xml"
-        write_xml(xml_path, [])
+        write_xml(xml_path, [unicodedata.normalize("NFD", str(referenced))])
 
         result = run_cli([
+            "move",
+            "--rekordbox-xml", str(xml_path),
+            "--scan-root", str(scan_root),
+        ])
+
+        assert result.returncode == 0, f"CLI failed: {result.stderr}"
+        assert referenced.exists(), "Referenced file should not be treated as an orphan"
+        assert not orphan.exists(), "Orphan with a non-ASCII name should be moved"
+
+
+    def test_nfd_named_files_on_disk(self, tmp_path: Path, scan_root: Path) -> None:
+        """Test decomposed (NFD) names stored on disk are matched, checked and moved under their real name."""
+
+        referenced = scan_root / unicodedata.normalize("NFD", "Café Del Mar.mp3")
+        orphan = scan_root / unicodedata.normalize("NFD", "Beyoncé.mp3")
+        outside = tmp_path / "Elsewhere" / unicodedata.normalize("NFD", "Sigur Rós.mp3")
+        touch_many([referenced, orphan, outside])
+
+        xml_path = tmp_path / "rekordbox.xml"
+        write_xml(xml_path, [unicodedata.normalize("NFC", str(referenced)), str(outside)])
+
+        preview = run_cli([
             "preview",
             "--rekordbox-xml", str(xml_path),
             "--scan-root", str(scan_root),
         ])
+        assert preview.returncode == 0, f"CLI failed: {preview.stderr}"
+        assert _orphan_count(preview.stdout) == 1
+        assert "Collection references missing on disk: 0" in preview.stdout, preview.stdout
+        assert "Exists but not scanned: 1" in preview.stdout, preview.stdout
 
-        assert result.returncode == 0
-        assert f"Scanned disk files: {len(extensions)}" in result.stdout
+        result = run_cli([
+            "move",
+            "--rekordbox-xml", str(xml_path),
+            "--scan-root", str(scan_root),
+        ])
+        assert result.returncode == 0, f"CLI failed: {result.stderr}"
+        assert "'moved': 1" in result.stdout and "'skipped_missing': 0" in result.stdout, result.stdout
+        assert referenced.exists(), "Referenced file should not be treated as an orphan"
+        assert not orphan.exists(), "NFD-named orphan should be moved"
+        assert (scan_root / "_Rekordbox_Orphans" / orphan.name).exists(), "Moved file should keep its on-disk name"
+
+
+@pytest.mark.slow
+class TestLargeCollection:
+    """
+    Benchmark: preview against a large generated collection.
+    Catches parser/scanner regressions that only show up at real library sizes.
+    Deselected by default; run with `pytest -m slow` (needs pytest-benchmark).
+    """
+
+    @pytest.mark.parametrize("n", [10_000, 100_000])
+    def test_preview_large_collection(self, tmp_path: Path, scan_root: Path, n: int, request: pytest.FixtureRequest) -> None:
+        pytest.importorskip("pytest_benchmark")
+        benchmark = request.getfixturevalue("benchmark")
+
+        # Half of the collection is on disk, plus one orphan per ten tracks; 1000 files per folder
+        tracks = [scan_root / f"{i // 1000:04d}" / f"track_{i}.mp3" for i in range(n)]
+        orphans = [scan_root / "orphans" / f"orphan_{i}.mp3" for i in range(n // 10)]
+        touch_many(tracks[: n // 2] + orphans)
+
+        # Stream the XML straight to disk, one TRACK per write
+        xml_path = tmp_path / "rekordbox.xml"
+        with xml_path.open("wb") as fp:
+            fp.write(_XML_HEAD)
+            fp.write(b'%d">\n' % n)
+            for i, track in enumerate(tracks, start=1):
+                fp.write(f'    <TRACK TrackID="{i}" Location="{track}" />\n'.encode("utf-8"))
+            fp.write(_XML_TAIL)
+
+        args = [
+            "preview",
+            "--rekordbox-xml", str(xml_path),
+            "--scan-root", str(scan_root),
+        ]
+        result = benchmark.pedantic(run_cli, args=(args,), rounds=3, iterations=1)
+
+        assert result.returncode == 0, f"CLI failed: {result.stderr}"
+        assert f"Scanned disk files: {n // 2 + n // 10}" in result.stdout
+        assert _orphan_count(result.stdout) == n // 10
+        assert f"Collection references missing on disk: {n - n // 2}" in result.stdout